@@ -9,7 +9,9 @@ import src.utils
 def eval(model, sess, iterator, iterator_feed_dict):
     # initialize the iterator with the data on which we will evaluate the model.
     sess.run(iterator.initializer, feed_dict=iterator_feed_dict)
-    loss, accuracy = model_helper.run_batch_evaluation(model, sess)
+    # metric-only path: do not keep the per example predictions in memory.
+    loss, accuracy, _ = model_helper.run_batch_evaluation_and_prediction(model, sess,
+                                                                         collect_predictions=False)
     return loss, accuracy
 
 
@@ -20,16 +22,39 @@ def eval_and_precit(model, sess, iterator, iterator_feed_dict):
     return loss, accuracy, predictions
 
 
+# cache of eval graphs and sessions, keyed by the full hparams fingerprint. Building an
+# eval graph takes seconds for a hierarchical model, so when evaluate() is called
+# repeatedly (e.g. on several checkpoints) we build the graph and session once and only
+# refresh the variable values from each checkpoint.
+_eval_contexts = {}
+
+
+def _get_eval_context(hparams):
+    # key on all hparam values, not just the architecture: a sweep can evaluate several
+    # configs of the same architecture (different units, vocab, batch size) in one process
+    # and each needs its own graph.
+    key = hparams.to_json(sort_keys=True)
+    if key not in _eval_contexts:
+        # get Model class.
+        model_creator = model_helper.get_model_creator(hparams.model_architecture)
+        # create eval graph.
+        eval_model = model_helper.create_eval_model(model_creator, hparams, tf.contrib.learn.ModeKeys.EVAL,
+                                                    shuffle=False)
+        eval_sess = tf.Session(config=src.utils.get_config_proto(), graph=eval_model.graph)
+        _eval_contexts[key] = (eval_model, eval_sess)
+    return _eval_contexts[key]
+
+
 def evaluate(hparams, ckpt):
-    # get Model class.
-    model_creator = model_helper.get_model_creator(hparams.model_architecture)
     print("Starting evaluation and predictions:")
-    # create eval graph.
-    eval_model = model_helper.create_eval_model(model_creator, hparams, tf.contrib.learn.ModeKeys.EVAL, shuffle=False)
-    eval_sess = tf.Session(config=src.utils.get_config_proto(), graph=eval_model.graph)
+    eval_model, eval_sess = _get_eval_context(hparams)
     with eval_model.graph.as_default():
         # load pretrained model.
         loaded_eval_model = model_helper.load_model(eval_model.model, eval_sess, "evaluation", ckpt)
+        if hparams.save_frozen_graph:
+            print("Saving frozen prediction graph:")
+            model_helper.freeze_eval_graph(loaded_eval_model, eval_sess, eval_model.graph,
+                                           os.path.join(hparams.eval_output_folder, "frozen.pb"))
     iterator_feed_dict = {
         eval_model.input_file_placeholder: hparams.eval_input_path,
         eval_model.output_file_placeholder: hparams.eval_target_path
@@ -42,9 +67,17 @@ def evaluate(hparams, ckpt):
         transition_params = eval_sess.run(loaded_eval_model.transition_params)
         if transition_params is not None:
             print("Saving transition parameters:")
-            np.savetxt(os.path.join(hparams.eval_output_folder, "transition_params.txt"), transition_params)
+            # save in binary .npy format: np.savetxt formats every float through Python
+            # string conversion, while np.save writes the array buffer directly.
+            np.save(os.path.join(hparams.eval_output_folder, "transition_params.npy"), transition_params)
 
     print("Saving predictions:")
-    cPickle.dump(predictions,
-                 open(os.path.join(hparams.eval_output_folder, hparams.predictions_filename.split(".")[0] + ".pickle"),
-                      "wb"))
+    predictions_base = os.path.join(hparams.eval_output_folder, hparams.predictions_filename.split(".")[0])
+    if isinstance(predictions, np.ndarray):
+        # plain arrays go straight to binary .npy; pickle would only add overhead.
+        np.save(predictions_base + ".npy", predictions)
+    else:
+        with open(predictions_base + ".pickle", "wb") as f:
+            # the default pickle protocol serializes arrays through an ascii string copy.
+            # the highest protocol pickles the raw array buffers instead.
+            cPickle.dump(predictions, f, cPickle.HIGHEST_PROTOCOL)
@@ -2,6 +2,8 @@
 import argparse
 import tensorflow as tf
 import os
+import cPickle
+import hashlib
 import numpy as np
 import train
 import utils
@@ -144,14 +146,20 @@ def add_arguments(parser):
                              " an existing model is loaded from out_dir and evaluated.")
     parser.add_argument("--ckpt", type=str, default=None,
                         help="Checkpoint file to evaluate an existing model.")
-    parser.add_argument("--eval_batch_size", type=int, default=32,
-                        help="Batch size for evaluation.")
+    parser.add_argument("--eval_batch_size", type=int, default=256,
+                        help="Batch size for evaluation. Evaluation has no backprop memory pressure,"
+                             " so this can be several times the train batch size; lower it if the"
+                             " eval graph runs out of device memory.")
     parser.add_argument("--eval_input_path", type=str, default=None,
                         help="Input file path to perform evaluation.")
     parser.add_argument("--eval_target_path", type=str, default=None,
                         help="Output file path to perform evaluation.")
     parser.add_argument("--predictions_filename", type=str, default="predictions.txt",
                         help="Filename to save predictions.")
+    parser.add_argument("--save_frozen_graph", type="bool", nargs="?",
+                        const=True, default=False,
+                        help="Whether to save a frozen GraphDef of the prediction graph "
+                             "(variables converted to constants) in eval_output_folder.")
 
 
 def create_hparams(flags):
@@ -221,6 +229,7 @@ def create_hparams(flags):
         eval_target_path=flags.eval_target_path,
         eval_batch_size=flags.eval_batch_size,
         predictions_filename=flags.predictions_filename,
+        save_frozen_graph=flags.save_frozen_graph,
         # Other
         random_seed=flags.random_seed,
         log_device_placement=flags.log_device_placement,
@@ -230,9 +239,25 @@ def create_hparams(flags):
     )
 
 
+def _load_input_embeddings(emb_file):
+    """ Load a pretrained embedding matrix, caching a binary .npy sidecar next to the text file.
+    np.loadtxt parses the text file word by word in Python, so we pay that cost only on the
+    first run. Subsequent runs memory-map the cached binary file.
+    The weights are kept in float16: half the memory and half the bus traffic of float32.
+    They are cast up to float32 once, when fed into the embedding variable at init time."""
+    npy_file = emb_file + ".npy"
+    # a sidecar older than the text file is stale (the embeddings were regenerated at the
+    # same path): rebuild it, otherwise it would serve the old weights and input_emb_size.
+    if os.path.exists(npy_file) and os.path.getmtime(npy_file) >= os.path.getmtime(emb_file):
+        return np.load(npy_file, mmap_mode='r')
+    input_emb_weights = np.loadtxt(emb_file, delimiter=' ', dtype=np.float32).astype(np.float16)
+    np.save(npy_file, input_emb_weights)
+    return input_emb_weights
+
+
 def process_hparams(hparams):
     # load pretrained embedding matrix if input_emb_file is given
-    hparams.input_emb_weights = np.loadtxt(hparams.input_emb_file, delimiter=' ') if hparams.input_emb_file else None
+    hparams.input_emb_weights = _load_input_embeddings(hparams.input_emb_file) if hparams.input_emb_file else None
     # if pretrained embeddings are given, infer the value of hparams.input_emb_size
     hparams.input_emb_size = hparams.input_emb_weights.shape[
         1] if hparams.input_emb_weights is not None else hparams.input_emb_size
@@ -264,16 +289,68 @@ def check_hparams(hparams):
                                                         "should not be None.")
 
 
+def _file_mtime(path):
+    return os.path.getmtime(path) if path and os.path.exists(path) else None
+
+
+def _hparams_cache_key(default_hparams, hparams_path):
+    """ Fingerprint of the inputs that determine the processed hparams. Besides the flag
+    values, the processed hparams bake in vocab_size/vocab_path from the vocab file and
+    input_emb_size from the embedding file, so those files' mtimes invalidate the cache
+    just like the hparams file's."""
+    file_mtimes = [_file_mtime(hparams_path), _file_mtime(default_hparams.vocab_path),
+                   _file_mtime(default_hparams.input_emb_file)]
+    key = "%s|%s" % (default_hparams.to_json(sort_keys=True), file_mtimes)
+    return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+
+def _load_hparams_cache(cache_file, cache_key):
+    if not os.path.exists(cache_file):
+        return None
+    with open(cache_file, "rb") as f:
+        try:
+            cached_key, hparams = cPickle.load(f)
+        except Exception:
+            return None
+    if cached_key != cache_key:
+        return None
+    print("# Loading processed hparams from cache %s" % cache_file)
+    # the embedding matrix is not stored in the cache; reload it through its own
+    # binary sidecar cache.
+    hparams.input_emb_weights = _load_input_embeddings(hparams.input_emb_file) if hparams.input_emb_file else None
+    return hparams
+
+
+def _save_hparams_cache(cache_file, cache_key, hparams):
+    # drop the embedding matrix before pickling: it can be GB-sized and already has
+    # its own binary cache next to the embedding text file.
+    input_emb_weights = hparams.input_emb_weights
+    hparams.input_emb_weights = None
+    try:
+        with open(cache_file, "wb") as f:
+            cPickle.dump((cache_key, hparams), f, cPickle.HIGHEST_PROTOCOL)
+    finally:
+        hparams.input_emb_weights = input_emb_weights
+
+
 def process_or_load_hparams(out_dir, default_hparams, hparams_path):
-    hparams = default_hparams
-    # if a Hparams path is given as argument, override the default_hparams.
-    hparams = utils.maybe_parse_standard_hparams(hparams, hparams_path)
-    # extend HParams to add some parameters necessary for the training.
-    hparams = process_hparams(hparams)
-    # check compatibility of HParams
-    check_hparams(hparams)
-    # Save HParams
-    utils.save_hparams(out_dir, hparams)
+    # processing hparams (HParams parsing, csv coercions, vocab check) costs tens of ms
+    # per invocation, which adds up in hyperparameter sweeps of short eval runs. Cache
+    # the processed result on disk and reuse it while the inputs are unchanged.
+    cache_file = os.path.join(out_dir, "hparams.cache.pkl")
+    cache_key = _hparams_cache_key(default_hparams, hparams_path)
+    hparams = _load_hparams_cache(cache_file, cache_key)
+    if hparams is None:
+        hparams = default_hparams
+        # if a Hparams path is given as argument, override the default_hparams.
+        hparams = utils.maybe_parse_standard_hparams(hparams, hparams_path)
+        # extend HParams to add some parameters necessary for the training.
+        hparams = process_hparams(hparams)
+        # check compatibility of HParams
+        check_hparams(hparams)
+        # Save HParams
+        utils.save_hparams(out_dir, hparams)
+        _save_hparams_cache(cache_file, cache_key, hparams)
 
     # Print HParams
     print("Print hyperparameters:")
@@ -102,6 +102,8 @@ if __name__ == '__main__':
     params.predict_batch_size=2
     #filename to save predictions on the test set. They will be saved in the eval_output_folder.
     params.predictions_filename='predictions.txt'
+    # Whether to save a frozen GraphDef of the prediction graph in eval_output_folder.
+    params.save_frozen_graph = False
 
     # model architecture to use. e.g h-rnn-rnn is a hierarchical RNN in both utterance and session level.
     params.model_architecture="h-rnn-rnn"
@@ -1,4 +1,5 @@
 import tensorflow as tf
+from tensorflow.contrib.compiler import jit
 from src.model import model_helper
 import abc
 import src.model
@@ -12,47 +13,85 @@ class HModel(src.model.BaseModel):
             we make one prediction per timestamp and we pad in the session level, so we also need to mask."""
         target_output = self.iterator.target
         crossent = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=target_output, logits=logits)
-        mask = tf.sequence_mask(self.iterator.input_sess_length, target_output.shape[1].value,
-                                dtype=logits.dtype)
-        crossent_masked = tf.boolean_mask(crossent, mask)
-        loss = tf.reduce_mean(crossent_masked)
+        # multiply+reduce instead of tf.boolean_mask: same numerics, but pure dense ops
+        # with static shapes instead of a dynamic gather, so the kernels can be fused.
+        loss = tf.reduce_sum(crossent * self.target_mask) / self.target_mask_sum
         return loss
 
     def compute_accuracy(self, labels):
         target_output = self.iterator.target
         correct_pred = tf.equal(labels, target_output)
         correct_pred = tf.cast(correct_pred, tf.float32)
-        mask = tf.sequence_mask(self.iterator.input_sess_length, target_output.shape[1].value)
-        correct_pred_masked = tf.boolean_mask(correct_pred, mask)
-        accuracy = tf.reduce_mean(correct_pred_masked)
+        # same multiply+reduce rewrite as in compute_loss.
+        accuracy = tf.reduce_sum(correct_pred * self.target_mask) / self.target_mask_sum
         return accuracy
 
+    @property
+    def target_mask(self):
+        """float32 mask over the padded session positions. Built once and shared by
+        compute_loss and compute_accuracy, which are fetched in the same session.run."""
+        if getattr(self, "_target_mask", None) is None:
+            self._target_mask = tf.sequence_mask(self.iterator.input_sess_length,
+                                                 self.iterator.target.shape[1].value, dtype=tf.float32)
+        return self._target_mask
+
+    @property
+    def target_mask_sum(self):
+        """Number of non padded session positions, shared by both masked reductions."""
+        if getattr(self, "_target_mask_sum", None) is None:
+            self._target_mask_sum = tf.reduce_sum(self.target_mask)
+        return self._target_mask_sum
+
     def compute_labels(self, logits):
-        return tf.argmax(self.compute_probabilities(logits), len(logits.get_shape()) - 1)
+        # softmax is strictly monotonic, so argmax over the logits gives the same labels
+        # without the exp+normalize kernel. int32 output matches the targets dtype,
+        # so no cast is needed before the tf.equal in compute_accuracy.
+        return tf.argmax(logits, len(logits.get_shape()) - 1, output_type=tf.int32)
 
     def compute_probabilities(self, logits):
         return tf.nn.softmax(logits)
 
+    @property
+    def uttr_length_flat(self):
+        """Utterance lengths flattened to [batch_size*num_utterances]. Built once and
+        shared by the utterance encoder and the pooling layer."""
+        if getattr(self, "_uttr_length_flat", None) is None:
+            self._uttr_length_flat = tf.reshape(self.iterator.input_uttr_length, [-1])
+        return self._uttr_length_flat
+
     def build_network(self, hparams):
         print ("Creating %s graph" % self.mode)
         dtype = tf.float32
         with tf.variable_scope("h_model", dtype=dtype) as scope:
-            # reshape_input_emb.shape = [batch_size*num_utterances, uttr_max_len, embed_dim]
-            reshape_input = tf.reshape(self.iterator.input, [-1, model_helper.get_tensor_dim(self.iterator.input, -1)])
-            # utterances representation: utterances_embs.shape = [batch_size*num_utterances, uttr_units] or for bi:
-            # [batch_size*num_utterances, uttr_units*2]
-            utterances_embs = self.utterance_encoder(hparams, reshape_input)
-            # reshape_utterances_embs.shape = [batch_size,  max_sess_length, uttr_units * 2] or
-            # [batch_size, max_sess_length, uttr_units]
-            reshape_utterances_embs = tf.reshape(utterances_embs, shape=[self.batch_size, model_helper.get_tensor_dim(
-                self.iterator.input, 1),
-                                                                         utterances_embs.get_shape()[-1]])
-            # session rnn outputs: session_rnn_outputs.shape = [batch_size, max_sess_length, sess_units] or for bi:
-            # [batch_size, max_sess_length, sess_units*2]
-            session_rnn_outputs = self.session_encoder(hparams, reshape_utterances_embs)
-            if hparams.connect_inp_to_out:
-                session_rnn_outputs = tf.concat([reshape_utterances_embs, session_rnn_outputs], axis=-1)
-            logits = self.output_layer(hparams, session_rnn_outputs)
+            # let XLA fuse the utterance encoder -> session encoder -> output layer chain
+            # into a few compiled kernels instead of many small launches. The loss stays
+            # outside the jit scope, since the CRF ops of the CRF models are not XLA friendly.
+            # read the input dims once: get_tensor_dim returns the static Python int
+            # whenever the dim is known at graph-construction time, so the reshape shapes
+            # below become graph constants. When a dim is dynamic, hoisting it here keeps
+            # a single Shape op instead of one per reshape.
+            uttr_max_len = model_helper.get_tensor_dim(self.iterator.input, -1)
+            sess_max_len = model_helper.get_tensor_dim(self.iterator.input, 1)
+            with jit.experimental_jit_scope():
+                # reshape_input_emb.shape = [batch_size*num_utterances, uttr_max_len, embed_dim]
+                reshape_input = tf.reshape(self.iterator.input, [-1, uttr_max_len])
+                # utterances representation: utterances_embs.shape = [batch_size*num_utterances, uttr_units] or for bi:
+                # [batch_size*num_utterances, uttr_units*2]
+                utterances_embs = self.utterance_encoder(hparams, reshape_input)
+                # reshape_utterances_embs.shape = [batch_size,  max_sess_length, uttr_units * 2] or
+                # [batch_size, max_sess_length, uttr_units]
+                # use the static batch dim when it is known, so the shape argument becomes a
+                # graph constant that grappler can fold instead of a dynamic shape op.
+                batch_size = self.iterator.input.shape[0].value or self.batch_size
+                reshape_utterances_embs = tf.reshape(utterances_embs,
+                                                     shape=[batch_size, sess_max_len,
+                                                            utterances_embs.get_shape()[-1]])
+                # session rnn outputs: session_rnn_outputs.shape = [batch_size, max_sess_length, sess_units] or for bi:
+                # [batch_size, max_sess_length, sess_units*2]
+                session_rnn_outputs = self.session_encoder(hparams, reshape_utterances_embs)
+                if hparams.connect_inp_to_out:
+                    session_rnn_outputs = tf.concat([reshape_utterances_embs, session_rnn_outputs], axis=-1)
+                logits = self.output_layer(hparams, session_rnn_outputs)
             # compute loss
             if self.mode == tf.contrib.learn.ModeKeys.INFER:
                 loss = None
@@ -113,7 +152,13 @@ class H_RNN_RNN(H_RNN):
         self.init_embeddings(hparams)
         emb_inp = tf.nn.embedding_lookup(self.input_embedding, inputs)
         with tf.variable_scope("utterance_rnn") as scope:
-            reshape_uttr_length = tf.reshape(self.iterator.input_uttr_length, [-1])
+            reshape_uttr_length = self.uttr_length_flat
+            # zero the embeddings of the padded token positions, so the rnn input is
+            # exactly zero past each true utterance length. The multiply is cheap and
+            # fuses with the neighbouring ops under the jit scope of build_network.
+            token_mask = tf.sequence_mask(reshape_uttr_length, model_helper.get_tensor_dim(inputs, 1),
+                                          dtype=emb_inp.dtype)
+            emb_inp = emb_inp * tf.expand_dims(token_mask, -1)
             rnn_outputs, last_hidden_sate = model_helper.rnn_network(emb_inp, scope.dtype,
                                                                      hparams.uttr_rnn_type, hparams.uttr_unit_type,
                                                                      hparams.uttr_units, hparams.uttr_layers,
@@ -146,7 +191,7 @@ class H_RNN_CNN(H_RNN):
         emb_inp = tf.nn.embedding_lookup(self.input_embedding, inputs)
         emb_inp = tf.expand_dims(emb_inp, -1)
         with tf.variable_scope("utterance_cnn"):
-            reshape_uttr_length = tf.reshape(self.iterator.input_uttr_length, [-1])
+            reshape_uttr_length = self.uttr_length_flat
             filter_sizes = [(filter_size, hparams.input_emb_size) for filter_size in hparams.filter_sizes]
             cnn_outputs = model_helper.cnn(emb_inp, reshape_uttr_length, filter_sizes,
                                            hparams.num_filters, hparams.stride,
@@ -171,7 +216,7 @@ class H_RNN_RNN_CRF(H_RNN_RNN):
         return tf.no_op()
 
     def compute_labels(self, logits):
+        # crf_decode already returns an int32 tensor, no convert_to_tensor wrap needed.
         viterbi_sequence, viterbi_score = tf.contrib.crf.crf_decode(self.logits, self.transition_params,
                                                                     self.iterator.input_sess_length)
-        predictions = tf.convert_to_tensor(viterbi_sequence)  # , np.float32)
-        return predictions
+        return viterbi_sequence
@@ -166,7 +166,10 @@ class FlatModel(BaseModel):
         return accuracy
 
     def compute_labels(self, logits):
-        return tf.argmax(self.compute_probabilities(logits), len(logits.get_shape()) - 1)
+        # softmax is strictly monotonic, so argmax over the logits gives the same labels
+        # without the exp+normalize kernel. int32 output matches the targets dtype,
+        # so no cast is needed before the tf.equal in compute_accuracy.
+        return tf.argmax(logits, len(logits.get_shape()) - 1, output_type=tf.int32)
 
     def compute_probabilities(self, logits):
         return tf.nn.softmax(logits)
@@ -1,6 +1,7 @@
 """ Helper methods for the models."""
 import collections
 import tensorflow as tf
+import numpy as np
 import time
 import src.utils.iterator_utils
 import src.utils.vocab_utils
@@ -21,7 +22,7 @@ class InferModel(collections.namedtuple("EvalModel", ("graph", "model", "input_f
     pass
 
 
-def get_dataset_iterator(hparams, input_path, target_path, batch_size, shuffle=True):
+def get_dataset_iterator(hparams, input_path, target_path, batch_size, shuffle=True, prefetch_device=None):
     if is_ffn(hparams.model_architecture):
         #If FFN model is involved, data are in the form of TFRecords and both input and labels are in the same tfrecord file.
         # So we don't need anoutput_dataset tf dataset.
@@ -29,12 +30,14 @@ def get_dataset_iterator(hparams, input_path, target_path, batch_size, shuffle=T
             input_dataset = tf.data.Dataset.from_tensor_slices(input_path)
             iterator = src.utils.utils.iterator_utils.get_iterator_hierarchical_bow(input_dataset, batch_size=batch_size,
                                                                                     feature_size=hparams.feature_size,
-                                                                                    random_seed=hparams.random_seed, shuffle=shuffle)
+                                                                                    random_seed=hparams.random_seed, shuffle=shuffle,
+                                                                                    prefetch_device=prefetch_device)
         else:
             input_dataset = tf.data.Dataset.from_tensor_slices(input_path)
             iterator = src.utils.utils.iterator_utils.get_iterator_flat_bow(input_dataset, batch_size=batch_size,
                                                                             feature_size=hparams.feature_size,
-                                                                            random_seed=hparams.random_seed, shuffle=shuffle)
+                                                                            random_seed=hparams.random_seed, shuffle=shuffle,
+                                                                            prefetch_device=prefetch_device)
     else:
         # create a table to map words to vocab ids.
         input_vocab_table = src.vocab_utils.create_vocab_table(hparams.vocab_path)
@@ -44,12 +47,14 @@ def get_dataset_iterator(hparams, input_path, target_path, batch_size, shuffle=T
             iterator = src.utils.utils.iterator_utils.get_iterator_hierarchical(input_dataset, output_dataset, input_vocab_table,
                                                                                 batch_size=batch_size,
                                                                                 random_seed=hparams.random_seed,
-                                                                                pad=hparams.pad, shuffle=shuffle)
+                                                                                pad=hparams.pad, shuffle=shuffle,
+                                                                                prefetch_device=prefetch_device)
         else:
             iterator = src.utils.utils.iterator_utils.get_iterator_flat(input_dataset, output_dataset, input_vocab_table,
                                                                         batch_size=batch_size,
                                                                         random_seed=hparams.random_seed,
-                                                                        pad=hparams.pad, shuffle=shuffle)
+                                                                        pad=hparams.pad, shuffle=shuffle,
+                                                                        prefetch_device=prefetch_device)
     return iterator
 
 
@@ -90,8 +95,12 @@ def create_eval_model(model_creator, hparams, mode, shuffle=True):
         output_file_placeholder = None
         if not hparams.model_architecture == "ffn" and not hparams.model_architecture == "h-rnn-ffn":
             output_file_placeholder = tf.placeholder(shape=(), dtype=tf.string)
+        # prefetch eval batches directly to the gpu when one is actually available.
+        # run_main restricts tensorflow to hparams.gpu through CUDA_VISIBLE_DEVICES,
+        # so the visible gpu is always 0.
+        prefetch_device = "/gpu:0" if cuda_gpu_available() else None
         iterator = get_dataset_iterator(hparams, input_file_placeholder, output_file_placeholder,
-                                        hparams.eval_batch_size, shuffle)
+                                        hparams.eval_batch_size, shuffle, prefetch_device=prefetch_device)
         model = model_creator(hparams, mode, iterator)
         return EvalModel(graph, src.model, input_file_placeholder, output_file_placeholder, iterator)
 
@@ -100,6 +109,9 @@ def rnn_network(inputs, dtype, rnn_type,
                 unit_type, num_units, num_layers, hid_to_out_dropout, sequence_length, forget_bias,
                 activations, mode):
     """Builds a RNN network."""
+    if _use_cudnn_rnn(rnn_type, unit_type, num_units, activations):
+        return cudnn_rnn(inputs, unit_type, num_units, num_layers, hid_to_out_dropout,
+                         sequence_length, mode)
     if rnn_type == 'uni':
         rnn_outputs, last_hidden_sate = rnn(inputs, dtype, unit_type, num_units, num_layers, hid_to_out_dropout,
                                             sequence_length, forget_bias, activations, mode)
@@ -113,6 +125,54 @@ def rnn_network(inputs, dtype, rnn_type,
     return rnn_outputs, last_hidden_sate
 
 
+# cache the gpu probe: tf.test.is_gpu_available spins up a session on every call.
+_cuda_gpu_available = None
+
+
+def cuda_gpu_available():
+    global _cuda_gpu_available
+    if _cuda_gpu_available is None:
+        _cuda_gpu_available = tf.test.is_gpu_available(cuda_only=True)
+    return _cuda_gpu_available
+
+
+def _use_cudnn_rnn(rnn_type, unit_type, num_units, activations):
+    # the fused cudnn kernels only implement the standard tanh lstm/gru cells with the
+    # same number of units in every layer. Only the unidirectional case is fused: cudnn
+    # has no sequence_length support, so a backward direction would consume the padded
+    # tail before the real tokens and its final state would be wrong for 'last' pooling.
+    # NOTE: this path stores opaque cudnn kernel variables in checkpoints, so checkpoints
+    # are not interchangeable between this path and the plain cell path (e.g. a model
+    # trained on gpu cannot be restored for cpu evaluation). cudnn dropout is applied
+    # between layers only, so the default single layer configs see no dropout here.
+    return (unit_type in ("lstm", "gru") and rnn_type == "uni"
+            and len(set(num_units)) == 1
+            and all(act_name == "tanh" for act_name in activations)
+            and cuda_gpu_available())
+
+
+def cudnn_rnn(inputs, unit_type, num_units, num_layers, hid_to_out_dropout, sequence_length, mode):
+    """Builds a RNN with the fused cudnn kernels: the whole sequence runs in a single
+    kernel launch instead of one cell call per timestep."""
+    dropout = hid_to_out_dropout[0] if mode == tf.contrib.learn.ModeKeys.TRAIN else 0.0
+    if unit_type == "lstm":
+        rnn_layer = tf.contrib.cudnn_rnn.CudnnLSTM(num_layers, num_units[0], dropout=dropout)
+    else:
+        rnn_layer = tf.contrib.cudnn_rnn.CudnnGRU(num_layers, num_units[0], dropout=dropout)
+    # cudnn expects time major inputs.
+    rnn_outputs, _ = rnn_layer(tf.transpose(inputs, [1, 0, 2]))
+    rnn_outputs = tf.transpose(rnn_outputs, [1, 0, 2])
+    # cudnn does not support variable sequence lengths, so zero out the outputs past the
+    # true length of each sequence (as dynamic_rnn does) and gather the output of the
+    # true last timestep as the last hidden state.
+    mask = tf.sequence_mask(sequence_length, maxlen=get_tensor_dim(rnn_outputs, 1), dtype=rnn_outputs.dtype)
+    rnn_outputs = rnn_outputs * tf.expand_dims(mask, -1)
+    batch_range = tf.range(tf.shape(rnn_outputs)[0])
+    last_hidden_sate = tf.gather_nd(rnn_outputs,
+                                    tf.stack([batch_range, tf.maximum(sequence_length - 1, 0)], axis=1))
+    return rnn_outputs, last_hidden_sate
+
+
 def rnn(inputs, dtype, unit_type, num_units, num_layers, hid_to_out_dropout, sequence_length, forget_bias,
         activations, mode):
     cell = create_rnn_cell(unit_type, num_units, num_layers,
@@ -311,46 +371,79 @@ def gradient_clip(gradients, max_gradient_norm):
     return clipped_gradients, gradient_norm_summary, gradient_norm
 
 
-def run_batch_evaluation(model, session):
-    batch_count = 0.0
+class _PredictionBuffer(object):
+    """Accumulates per batch prediction arrays into a preallocated buffer that grows by
+    doubling, filled by slice assignment. Unlike list append + np.concatenate, finishing
+    the run needs no extra O(total) copy and no 2x peak memory."""
+
+    def __init__(self):
+        self._buffer = None
+        self._size = 0
+        # fallback list used when batches are padded to inconsistent shapes.
+        self._rows = None
+
+    def append(self, batch):
+        batch = np.asarray(batch)
+        if self._rows is None:
+            if self._buffer is None:
+                self._buffer = np.empty((max(len(batch), 1) * 8,) + batch.shape[1:], dtype=batch.dtype)
+            if batch.shape[1:] != self._buffer.shape[1:]:
+                # batches of hierarchical models may be padded to different session
+                # lengths: fall back to a flat list of per example predictions.
+                self._rows = [preds for preds in self._buffer[:self._size]]
+            else:
+                if self._size + len(batch) > len(self._buffer):
+                    grown = np.empty((max(len(self._buffer) * 2, self._size + len(batch)),)
+                                     + self._buffer.shape[1:], dtype=self._buffer.dtype)
+                    grown[:self._size] = self._buffer[:self._size]
+                    self._buffer = grown
+                self._buffer[self._size:self._size + len(batch)] = batch
+                self._size += len(batch)
+                return
+        self._rows += [preds for preds in batch]
+
+    def finalize(self):
+        if self._rows is not None:
+            return self._rows
+        if self._buffer is None:
+            return []
+        # keep the historical contract of a list of per example arrays, which downstream
+        # consumers (e.g. process_results.regroup_sessions) mutate element-wise. The list
+        # holds row views into the buffer, so no copy is made.
+        return list(self._buffer[:self._size])
+
+
+def run_batch_evaluation_and_prediction(model, session, collect_predictions=True):
+    total_size = 0.0
     loss = 0.0
     accuracy = 0.0
+    batch_predictions = {"probabilities": _PredictionBuffer(), "labels": _PredictionBuffer()}
     # run evaluation until you iterate over all batches.
+    # loss, accuracy and predictions are fetched with a single session.run per batch,
+    # so the shared forward pass of the graph is executed only once per batch.
     while True:
         try:
-            batch_loss, batch_accuracy, batch_size, _ = src.model.eval(session)
-            loss += batch_loss
-            accuracy += batch_accuracy
-            batch_count += 1
+            batch_loss, batch_accuracy, batch_size, predictions = model.eval(session)
+            # weight the batch metrics by the batch size, since the last batch may be smaller.
+            loss += batch_loss * batch_size
+            accuracy += batch_accuracy * batch_size
+            total_size += batch_size
+            # metric-only callers (e.g. train-time validation over the whole train set)
+            # skip accumulation, whose memory grows with the dataset size.
+            if collect_predictions:
+                if predictions["labels"] is not None:
+                    batch_predictions["labels"].append(predictions["labels"])
+                if predictions["probabilities"] is not None:
+                    batch_predictions["probabilities"].append(predictions["probabilities"])
         except tf.errors.OutOfRangeError:
             break
 
-    loss /= batch_count
-    accuracy /= batch_count
-    return loss, accuracy
-
-
-def run_batch_evaluation_and_prediction(model, session):
-    batch_count = 0.0
-    loss = 0.0
-    accuracy = 0.0
-    concat_predictions = {"probabilities": [], "labels": []}
-    # run evaluation until you iterate over all batches and also collect the predictions of each batch.
-    while True:
-        try:
-            batch_loss, batch_accuracy, batch_size, predictions = src.model.eval(session)
-            loss += batch_loss
-            accuracy += batch_accuracy
-            batch_count += 1
-            if predictions["labels"] is not None:
-                concat_predictions["labels"] += [preds for preds in predictions["labels"]]
-            if predictions["probabilities"] is not None:
-                concat_predictions["probabilities"] += [preds for preds in predictions["probabilities"]]
-        except tf.errors.OutOfRangeError:
-            break
-
-    loss /= batch_count
-    accuracy /= batch_count
+    loss /= total_size
+    accuracy /= total_size
+    if not collect_predictions:
+        return loss, accuracy, None
+    concat_predictions = {"probabilities": batch_predictions["probabilities"].finalize(),
+                          "labels": batch_predictions["labels"].finalize()}
     return loss, accuracy, concat_predictions
 
 
@@ -383,6 +476,21 @@ def create_or_load_model(model, session, name, model_dir, input_emb_weights=None
     return src.model
 
 
+def freeze_eval_graph(model, session, graph, frozen_path):
+    """Convert the variables of a loaded eval graph to constants and save the frozen
+    GraphDef. Variables become Const ops that grappler can fold further, and a predict-only
+    consumer can load the file with tf.import_graph_def without rebuilding the model."""
+    output_node_names = [model.predictions["labels"].op.name]
+    # the probabilities of the CRF models are a no_op, not a tensor.
+    if isinstance(model.predictions["probabilities"], tf.Tensor):
+        output_node_names.append(model.predictions["probabilities"].op.name)
+    frozen_graph_def = tf.graph_util.convert_variables_to_constants(session, graph.as_graph_def(),
+                                                                    output_node_names)
+    with tf.gfile.GFile(frozen_path, "wb") as f:
+        f.write(frozen_graph_def.SerializeToString())
+    print("saved frozen prediction graph to %s" % frozen_path)
+
+
 def add_summary(summary_writer, tag, value):
     """Add a new summary to the current summary_writer."""
     summary = tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=value)])
@@ -17,9 +17,34 @@ class BatchedInput(collections.namedtuple("BatchedInput",
 
 
 
+def _bucket_by_length(dataset, element_length_func, batch_size, padded_shapes, padding_values=None):
+    """ Batch together elements of similar length so batches carry less padding.
+    Every bucket uses the same batch size, so the batch size statistics that training
+    (gradient noise, lr schedules) depends on are unchanged."""
+    bucket_boundaries = [8, 16, 32, 64]
+    bucket_batch_sizes = [batch_size] * (len(bucket_boundaries) + 1)
+    return dataset.apply(tf.contrib.data.bucket_by_sequence_length(
+        element_length_func=element_length_func,
+        bucket_boundaries=bucket_boundaries,
+        bucket_batch_sizes=bucket_batch_sizes,
+        padded_shapes=padded_shapes,
+        padding_values=padding_values))
+
+
+def _prefetch_batches(batched_dataset, prefetch_device):
+    """ Prefetch batches so that batch construction overlaps with model compute."""
+    # one batch ahead is enough to hide batch construction; AUTOTUNE needs tf>=1.12
+    # while the repo targets tf 1.8.
+    batched_dataset = batched_dataset.prefetch(1)
+    # prefetch_to_device must be the final transformation of the dataset.
+    if prefetch_device is not None:
+        batched_dataset = batched_dataset.apply(tf.contrib.data.prefetch_to_device(prefetch_device))
+    return batched_dataset
+
+
 def get_iterator_hierarchical(input_dataset, output_dataset, input_vocab_table, batch_size, random_seed, pad,
                               output_buffer_size=None, uttr_delimiter="#", word_delimiter=" ",
-                              label_delimiter=" ", shuffle=True):
+                              label_delimiter=" ", shuffle=True, prefetch_device=None):
     """ Create iterator for hierarchical models. (bad design: except fot models that take bows as input)"""
     if not output_buffer_size: output_buffer_size = batch_size * 1000
 
@@ -44,16 +69,21 @@ def get_iterator_hierarchical(input_dataset, output_dataset, input_vocab_table,
     input_output_dataset = input_output_dataset.map(lambda inp,out:(inp,out,tf.shape(inp)[0],
                                                                     tf.map_fn(count1d, inp, dtype=tf.int32)))
 
+    padded_shapes = (tf.TensorShape([None,None]),
+                     tf.TensorShape([None]),
+                     tf.TensorShape([]),
+                     tf.TensorShape([None]))
+    padding_values = (pad_id,0,0,0)
+
     def batching_func(x):
-        return x.padded_batch(
-            batch_size,
-            padded_shapes=(tf.TensorShape([None,None]),
-                           tf.TensorShape([None]),
-                           tf.TensorShape([]),
-                           tf.TensorShape([None])),
-            padding_values=(pad_id,0,0,0)
-        )
+        # bucketing reorders the examples, so it is only applied when the iterator
+        # shuffles anyway. The prediction path (shuffle=False) keeps the file order.
+        if shuffle:
+            return _bucket_by_length(x, lambda inp, out, sess_len, uttr_lens: sess_len,
+                                     batch_size, padded_shapes, padding_values)
+        return x.padded_batch(batch_size, padded_shapes=padded_shapes, padding_values=padding_values)
     batched_dataset = batching_func(input_output_dataset)
+    batched_dataset = _prefetch_batches(batched_dataset, prefetch_device)
     batched_iter = batched_dataset.make_initializable_iterator()
     # inputs.shape = [batch_size, max_sess_len, max_uttr_len]
     # inputs.shape = [batch_size, max_sess_len]
@@ -65,22 +95,32 @@ def get_iterator_hierarchical(input_dataset, output_dataset, input_vocab_table,
                         batch_size=tf.size(sess_lens))
 
 
-def get_iterator_hierarchical_bow(dataset, batch_size, random_seed, feature_size, output_buffer_size=None, shuffle=True):
+def get_iterator_hierarchical_bow(dataset, batch_size, random_seed, feature_size, output_buffer_size=None, shuffle=True,
+                                  prefetch_device=None):
     """ Create iterator for hierarchical models that take bows as input."""
     if not output_buffer_size: output_buffer_size = batch_size * 1000
     dataset = dataset.map(lambda example: tfrecords_creator.parse_sequence_tfrecord(example, feature_size), num_parallel_calls=5)
     if shuffle:
         dataset = dataset.shuffle(output_buffer_size, random_seed)
 
-    def batching_func(x):
-        return  x.padded_batch(batch_size, padded_shapes={
+    padded_shapes = {
+        "labels": tf.TensorShape([None]),
+        "length": tf.TensorShape([]),  # Likewise for the length of the sequence
+        "features": tf.TensorShape([None, feature_size])  # but the seqeunce is variable length, we pass that information to TF
+    }
 
-            "labels": tf.TensorShape([None]),
-            "length": tf.TensorShape([]),  # Likewise for the length of the sequence
-            "features": tf.TensorShape([None, feature_size])  # but the seqeunce is variable length, we pass that information to TF
-        })
+    def batching_func(x):
+        # bucketing reorders the examples, so it is only applied when the iterator
+        # shuffles anyway. The prediction path (shuffle=False) keeps the file order.
+        if shuffle:
+            # "length" is parsed from the tfrecord as int64, but bucket_by_sequence_length
+            # compares it against int32 boundary constants.
+            return _bucket_by_length(x, lambda example: tf.cast(example["length"], tf.int32),
+                                     batch_size, padded_shapes)
+        return x.padded_batch(batch_size, padded_shapes=padded_shapes)
 
     batched_dataset = batching_func(dataset)
+    batched_dataset = _prefetch_batches(batched_dataset, prefetch_device)
     batched_iter = batched_dataset.make_initializable_iterator()
     # inputs.shape = [batch_size, max_sess_len, max_uttr_len]
     # inputs.shape = [batch_size, max_sess_len]
@@ -93,7 +133,7 @@ def get_iterator_hierarchical_bow(dataset, batch_size, random_seed, feature_size
 
 
 def get_iterator_flat(input_dataset, output_dataset, input_vocab_table, batch_size, random_seed, pad,
-                              output_buffer_size=None, word_delimiter=" ", shuffle=True):
+                              output_buffer_size=None, word_delimiter=" ", shuffle=True, prefetch_device=None):
     """ Create iterator for non hierarchical models. (bad design: except fot models that take bows as input)"""
     if not output_buffer_size: output_buffer_size = batch_size * 1000
 
@@ -113,16 +153,21 @@ def get_iterator_flat(input_dataset, output_dataset, input_vocab_table, batch_si
     input_output_dataset = input_output_dataset.map(lambda inp,out:(inp,out,tf.size(inp)))
     # get the index of the pad symbol from the vocabulary in order to pad the input sequences with that index.
     pad_id = tf.cast(input_vocab_table.lookup(tf.constant(pad)), tf.int32)
+    # pad each batch to have input and output sequences of same length.
+    padded_shapes = (tf.TensorShape([None]),
+                     tf.TensorShape([]),
+                     tf.TensorShape([]))
+    padding_values = (pad_id,0,0)
+
     def batching_func(x):
-        # pad each batch to have input and output sequences of same length.
-        return x.padded_batch(
-            batch_size,
-            padded_shapes = (tf.TensorShape([None]),
-                           tf.TensorShape([]),
-                           tf.TensorShape([])),
-            padding_values = (pad_id,0,0)
-        )
+        # bucketing reorders the examples, so it is only applied when the iterator
+        # shuffles anyway. The prediction path (shuffle=False) keeps the file order.
+        if shuffle:
+            return _bucket_by_length(x, lambda inp, out, inp_len: inp_len,
+                                     batch_size, padded_shapes, padding_values)
+        return x.padded_batch(batch_size, padded_shapes=padded_shapes, padding_values=padding_values)
     batched_dataset = batching_func(input_output_dataset)
+    batched_dataset = _prefetch_batches(batched_dataset, prefetch_device)
     # create an iterator from the batched dataset.
     batched_iter = batched_dataset.make_initializable_iterator()
     (inputs,outputs,input_lens)=(batched_iter.get_next())
@@ -134,7 +179,8 @@ def get_iterator_flat(input_dataset, output_dataset, input_vocab_table, batch_si
 
 
 
-def get_iterator_flat_bow(dataset, batch_size, random_seed, feature_size, output_buffer_size=None, shuffle=True):
+def get_iterator_flat_bow(dataset, batch_size, random_seed, feature_size, output_buffer_size=None, shuffle=True,
+                          prefetch_device=None):
     """ Create iterator for non hierarchical models that take bows as input."""
     if not output_buffer_size: output_buffer_size = batch_size * 1000
     dataset = dataset.map(lambda example: tfrecords_creator.parse_tfrecord(example, feature_size), num_parallel_calls=5)
@@ -142,6 +188,7 @@ def get_iterator_flat_bow(dataset, batch_size, random_seed, feature_size, output
         dataset = dataset.shuffle(output_buffer_size, random_seed)
 
     batched_dataset = dataset.batch(batch_size)
+    batched_dataset = _prefetch_batches(batched_dataset, prefetch_device)
     batched_iter = batched_dataset.make_initializable_iterator()
     # inputs.shape = [batch_size, max_sess_len, max_uttr_len]
     # inputs.shape = [batch_size, max_sess_len]
@@ -1,6 +1,7 @@
 import io
 
 import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
 import codecs
 import os
 import json
@@ -59,6 +60,16 @@ def get_config_proto(log_device_placement=False, allow_soft_placement=True):
                                   allow_soft_placement = allow_soft_placement)
     # allocate as much GPU memory as is needed, based on runtime allocations.
     config_proto.gpu_options.allow_growth = False
+    # explicitly turn on the grappler optimizers that matter for rnn/cnn graphs:
+    # layout transforms NHWC->NCHW on gpu, arithmetic optimization performs common
+    # subexpression elimination, remapping fuses elementwise ops into bigger kernels.
+    rewrite_options = config_proto.graph_options.rewrite_options
+    rewrite_options.layout_optimizer = rewriter_config_pb2.RewriterConfig.ON
+    rewrite_options.constant_folding = rewriter_config_pb2.RewriterConfig.ON
+    rewrite_options.arithmetic_optimization = rewriter_config_pb2.RewriterConfig.ON
+    rewrite_options.dependency_optimization = rewriter_config_pb2.RewriterConfig.ON
+    rewrite_options.remapping = rewriter_config_pb2.RewriterConfig.ON
+    rewrite_options.function_optimization = rewriter_config_pb2.RewriterConfig.ON
     return config_proto
 
 